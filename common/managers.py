@@ -1,10 +1,22 @@
-from django.db.models import QuerySet, Max, CharField, Value
-from django.db.models.functions import Concat
+from functools import cache
+
+from django.db import connections, transaction
+from django.db.models import QuerySet, F, Max, OuterRef, Subquery, Window
+from django.db.models.functions import RowNumber
 from django.db.models.manager import BaseManager
 
 from common.exceptions import OperationConflictsConfigError
 
 
+@cache
+def _row_number_window(group_by, date_field):
+    return Window(
+        RowNumber(),
+        partition_by=[F(field) for field in group_by],
+        order_by=[F(date_field).desc(), F('pk').desc()],
+    )
+
+
 class AutoDeleteQuerySet(QuerySet):
     def bulk_create(
             self,
@@ -15,10 +27,14 @@ class AutoDeleteQuerySet(QuerySet):
             update_fields=None,
             unique_fields=None
     ):
-        if self.model.objects.count() + len(objs) > self.model.get_max_objects_count():
-            raise OperationConflictsConfigError('Cannot bulk create objs over max count (configured in the model)')
-        res = super().bulk_create(objs, batch_size, ignore_conflicts, update_conflicts, update_fields, unique_fields)
-        self.model.try_delete_objects()
+        batch_size = batch_size or self.model.get_bulk_create_batch_size()
+        with transaction.atomic():
+            threshold = self.model.get_max_objects_count() - len(objs)
+            if threshold < 0 or self.model.objects.order_by('pk').values('pk')[threshold:threshold + 1].exists():
+                raise OperationConflictsConfigError('Cannot bulk create objs over max count (configured in the model)')
+            res = super().bulk_create(objs, batch_size, ignore_conflicts, update_conflicts, update_fields, unique_fields)
+            self.model._count_estimate = None
+            self.model.try_delete_objects()
         return res
 
 
@@ -29,25 +45,34 @@ class AutoDeleteManager(BaseManager.from_queryset(AutoDeleteQuerySet)):
 class HistoryQuerySet(QuerySet):
     def for_date(self, group_by, date_field, date=None, *args, **kwargs):
         if not isinstance(group_by, (tuple, list)):
-            group_by = [group_by]
-
-        separator = Value('!@&%^$;#@$')
-        concat_list = list(group_by)
-        for i in range(1, 2 * len(group_by), 2):
-            concat_list.insert(i, separator)
+            group_by = (group_by,)
 
         filters = {f'{date_field}__lte': date} if date else {}
 
-        result_oids = self \
-            .filter(**filters) \
-            .values(*group_by) \
-            .alias(max_date=Max(date_field)) \
-            .annotate(oid=Concat(*concat_list, 'max_date', output_field=CharField())) \
-            .values_list('oid', flat=True)
+        if not connections[self.db].features.supports_over_clause:
+            return self._for_date_grouped_max(group_by, date_field, filters)
 
         return self \
-            .annotate(oid=Concat(*concat_list, date_field, output_field=CharField())) \
-            .filter(oid__in=result_oids)
+            .filter(**filters) \
+            .annotate(row_number=_row_number_window(tuple(group_by), date_field)) \
+            .filter(row_number=1)
+
+    def _for_date_grouped_max(self, group_by, date_field, filters):
+        base = self.filter(**filters)
+        group_refs = {field: OuterRef(field) for field in group_by}
+        max_dates = base \
+            .filter(**group_refs) \
+            .values(*group_by) \
+            .annotate(max_date=Max(date_field)) \
+            .values('max_date')
+        max_pks = base \
+            .filter(**group_refs, **{date_field: OuterRef(date_field)}) \
+            .values(*group_by) \
+            .annotate(max_pk=Max('pk')) \
+            .values('max_pk')
+        return base \
+            .filter(**{date_field: Subquery(max_dates[:1])}) \
+            .filter(pk=Subquery(max_pks[:1]))
 
 
 class HistoryManager(BaseManager.from_queryset(HistoryQuerySet)):
@@ -1,9 +1,25 @@
-from threading import Lock
+import os
+from threading import Condition
+from time import monotonic
 import traceback
 from datetime import timedelta
 from typing import Type
 
-from django.db.models import Model, DateTimeField, TextField, BooleanField, F, Avg
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+from django.db.models import (
+    Model,
+    DateTimeField,
+    DurationField,
+    TextField,
+    BooleanField,
+    F,
+    Avg,
+    ExpressionWrapper,
+    Index,
+    Subquery,
+)
+from django.db.models.signals import class_prepared
 from django.utils import timezone
 
 from common.managers import HistoryManager, AutoDeleteManager
@@ -15,7 +31,23 @@ class BaseModel(Model):
         abstract = True
 
     def values(self, *fields, **expressions):
-        return type(self).objects.filter(pk=self.pk).values(*fields, **expressions)[0]
+        if fields and not expressions:
+            local_values = self._get_local_values(*fields)
+            if local_values is not None:
+                return local_values
+        return type(self).objects.values(*fields, **expressions).get(pk=self.pk)
+
+    def _get_local_values(self, *fields):
+        try:
+            meta_fields = [self._meta.get_field(name) for name in fields]
+        except FieldDoesNotExist:
+            return
+        if not all(
+                field.concrete and not field.is_relation and field.attname in self.__dict__
+                for field in meta_fields
+        ):
+            return
+        return {name: getattr(self, field.attname) for name, field in zip(fields, meta_fields)}
 
 
 class TimedModel(BaseModel):
@@ -32,9 +64,7 @@ class TimedModel(BaseModel):
 
     @classmethod
     def get_last_created_object(cls, *args, **kwargs):
-        if not cls.objects.count():
-            return
-        return cls.objects.latest(*cls.get_ordering(*args, **kwargs))
+        return cls.objects.order_by(*cls.get_ordering(*args, **kwargs)).last()
 
 
 class DeletableModel(TimedModel):
@@ -42,36 +72,59 @@ class DeletableModel(TimedModel):
         abstract = True
 
     max_objects_count: int = None
+    bulk_create_batch_size: int = int(os.environ.get('DJANGO_BULK_CREATE_BATCH_SIZE', 1000))
 
     @classmethod
     def get_max_objects_count(cls, *args, **kwargs):
         return cls.max_objects_count
 
     @classmethod
-    def get_objects_to_delete(cls, *args, **kwargs):
+    def get_bulk_create_batch_size(cls, *args, **kwargs):
+        return cls.bulk_create_batch_size
+
+    @classmethod
+    def get_objects_to_delete(cls, *args, current_count=None, **kwargs):
         max_objects_count = cls.get_max_objects_count(*args, **kwargs)
         objects_to_delete_count = 0
         if max_objects_count:
-            objects_to_delete_count = cls.objects.count() - max_objects_count
+            if current_count is None:
+                current_count = cls.objects.count()
+            objects_to_delete_count = current_count - max_objects_count
         if objects_to_delete_count <= 0:
             return cls.objects.none()
         return cls.objects.order_by(*cls.get_ordering(*args, **kwargs))[:objects_to_delete_count]
 
     @classmethod
-    def try_delete_objects(cls, *args, **kwargs):
-        objects_to_delete = cls.get_objects_to_delete(*args, **kwargs)
-        return cls.objects.filter(pk__in=objects_to_delete.values_list('pk', flat=True)).delete()
+    def try_delete_objects(cls, *args, current_count=None, **kwargs):
+        with transaction.atomic():
+            objects_to_delete = cls.get_objects_to_delete(*args, current_count=current_count, **kwargs)
+            return cls.objects.filter(pk__in=Subquery(objects_to_delete.values('pk'))).delete()
 
 
 class AutoDeletableModel(DeletableModel):
     class Meta:
         abstract = True
 
+    _count_estimate: int = None
+
     objects = AutoDeleteManager()
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        is_insert = self._state.adding
         super().save(force_insert, force_update, using, update_fields)
-        self.try_delete_objects()
+        cls = type(self)
+        if is_insert and cls._count_estimate is not None:
+            cls._count_estimate += 1
+        max_objects_count = cls.get_max_objects_count()
+        if not max_objects_count:
+            cls._count_estimate = None
+            cls.try_delete_objects()
+            return
+        if cls._count_estimate is not None and cls._count_estimate <= max_objects_count:
+            return
+        current_count = cls.objects.count()
+        deleted_count = cls.try_delete_objects(current_count=current_count)[1].get(cls._meta.label, 0)
+        cls._count_estimate = current_count - deleted_count
 
 
 class LogModel(AutoDeletableModel):
@@ -101,23 +154,42 @@ class UpdatableModel(BaseModel):
     class Meta:
         abstract = True
 
-    _update_lock = Lock()
-    _check_lock = Lock()
+    _state_condition = Condition()
+    _is_updating = False
     _time_started = None
     _must_terminate = False
+    _can_start_cached_at = None
+    _can_start_cached_result = None
 
     time_limit: timedelta = None
+    can_start_cache_time: float = 0.05
 
     @classmethod
     def get_time_limit(cls, *args, **kwargs):
         return cls.time_limit
 
+    @classmethod
+    def get_can_start_cache_time(cls, *args, **kwargs):
+        return cls.can_start_cache_time
+
     @classmethod
     def is_updating(cls, *args, **kwargs):
-        return cls._update_lock.locked()
+        return cls._is_updating
 
     @classmethod
     def is_can_start(cls, *args, **kwargs):
+        cache_time = cls.get_can_start_cache_time(*args, **kwargs)
+        current_time = monotonic()
+        if cache_time and cls._can_start_cached_at is not None \
+                and current_time - cls._can_start_cached_at < cache_time:
+            return cls._can_start_cached_result
+        result = cls._is_can_start(*args, **kwargs)
+        cls._can_start_cached_at = current_time
+        cls._can_start_cached_result = result
+        return result
+
+    @classmethod
+    def _is_can_start(cls, *args, **kwargs):
         if not cls.is_updating(*args, **kwargs):
             return True
         time_limit = cls.get_time_limit(*args, **kwargs)
@@ -149,38 +221,45 @@ class UpdatableModel(BaseModel):
 
     @classmethod
     def update(cls, *args, **kwargs):
-        cls._check_lock.acquire()
-
-        if not cls.is_can_start(*args, **kwargs):
-            cls._handle_cannot_start(*args, **kwargs)
-            cls._check_lock.release()
-            return False, None, None
-
-        cls._must_terminate = True
-
-        with cls._update_lock:
+        with cls._state_condition:
+            while True:
+                if not cls._is_can_start(*args, **kwargs):
+                    cls._handle_cannot_start(*args, **kwargs)
+                    return False, None, None
+                if not cls._is_updating:
+                    break
+                cls._must_terminate = True
+                cls._state_condition.wait()
+
+            cls._is_updating = True
             cls._must_terminate = False
             cls._time_started = timezone.now()
-            cls._check_lock.release()
+            cls._can_start_cached_at = None
+
+        is_update_successful = True
+        exception = None
+        exception_after_handling_attempt = None
 
-            is_update_successful = True
-            exception = None
-            exception_after_handling_attempt = None
+        try:
+            cls._pre_update(*args, **kwargs)
+            cls._update(*args, **kwargs)
+            cls._post_update(*args, **kwargs)
 
+        except Exception as exc:
+            is_update_successful = False
+            exception = exc
             try:
-                cls._pre_update(*args, **kwargs)
-                cls._update(*args, **kwargs)
-                cls._post_update(*args, **kwargs)
+                cls._handle_exception(exc, *args, **kwargs)
+            except Exception as exc2:
+                exception_after_handling_attempt = exc2
 
-            except Exception as exc:
-                is_update_successful = False
-                exception = exc
-                try:
-                    cls._handle_exception(exc, *args, **kwargs)
-                except Exception as exc2:
-                    exception_after_handling_attempt = exc2
+        finally:
+            with cls._state_condition:
+                cls._is_updating = False
+                cls._can_start_cached_at = None
+                cls._state_condition.notify_all()
 
-            return is_update_successful, exception, exception_after_handling_attempt
+        return is_update_successful, exception, exception_after_handling_attempt
 
 
 class UpdatableLoggableModel(UpdatableModel):
@@ -188,8 +267,10 @@ class UpdatableLoggableModel(UpdatableModel):
         abstract = True
 
     _log = None
+    _cached_average_update_time = None
 
     log_model: Type[UpdateLogModel] = None
+    log_select_related: tuple[str, ...] | list[str] = ()
     use_average_time: bool = False
     average_time_coefficient: float = 1
 
@@ -202,6 +283,18 @@ class UpdatableLoggableModel(UpdatableModel):
             )
         return log_model
 
+    @classmethod
+    def get_log_select_related(cls, *args, **kwargs):
+        return cls.log_select_related
+
+    @classmethod
+    def get_log_queryset(cls, *args, **kwargs):
+        queryset = cls.get_log_model(*args, **kwargs).objects.all()
+        select_related = cls.get_log_select_related(*args, **kwargs)
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        return queryset
+
     @classmethod
     def is_use_average_time(cls, *args, **kwargs):
         return cls.use_average_time
@@ -213,10 +306,13 @@ class UpdatableLoggableModel(UpdatableModel):
     @classmethod
     def get_last_update_time(cls, filters, *args, **kwargs):
         log_model = cls.get_log_model(*args, **kwargs)
-        objects = log_model.objects.filter(**filters)
-        if not objects:
-            return
-        return objects.latest(log_model.time_finished.field.name).time_finished
+        time_finished_field = log_model.time_finished.field.name
+        return cls \
+            .get_log_queryset(*args, **kwargs) \
+            .filter(**filters) \
+            .order_by(f'-{time_finished_field}') \
+            .values_list(time_finished_field, flat=True) \
+            .first()
 
     @classmethod
     def get_last_update_attempt_time(cls, *args, **kwargs):
@@ -238,9 +334,19 @@ class UpdatableLoggableModel(UpdatableModel):
 
     @classmethod
     def calc_average_update_time(cls, *args, **kwargs):
+        if cls._cached_average_update_time is None:
+            cls._cached_average_update_time = cls._calc_average_update_time(*args, **kwargs)
+        return cls._cached_average_update_time
+
+    @classmethod
+    def _calc_average_update_time(cls, *args, **kwargs):
         log_model = cls.get_log_model(*args, **kwargs)
-        return log_model \
-            .objects \
+        duration = ExpressionWrapper(
+            F(log_model.time_finished.field.name) - F(log_model.time_created.field.name),
+            output_field=DurationField(),
+        )
+        return cls \
+            .get_log_queryset(*args, **kwargs) \
             .filter(**{
                 f'{log_model.time_created.field.name}__isnull': False,
                 f'{log_model.time_finished.field.name}__isnull': False,
@@ -248,11 +354,11 @@ class UpdatableLoggableModel(UpdatableModel):
                 log_model.was_terminated.field.name: False,
                 log_model.has_failed.field.name: False,
             }) \
-            .aggregate(avg=Avg(F(log_model.time_finished.field.name) - F(log_model.time_created.field.name))) \
+            .aggregate(avg=Avg(duration)) \
             .get('avg')
 
     @classmethod
-    def is_can_start(cls, *args, **kwargs):
+    def _is_can_start(cls, *args, **kwargs):
         if not cls.is_updating(*args, **kwargs):
             return True
 
@@ -288,11 +394,14 @@ class UpdatableLoggableModel(UpdatableModel):
 
     @classmethod
     def _post_update(cls, *args, **kwargs):
+        log_model = cls.get_log_model(*args, **kwargs)
         cls._log.time_finished = timezone.now()
-        cls._log.save()
+        cls._log.save(update_fields=[log_model.time_finished.field.name])
+        cls._cached_average_update_time = None
 
     @classmethod
     def _handle_exception(cls, exception, *args, **kwargs):
+        log_model = cls.get_log_model(*args, **kwargs)
         if type(exception) is ProcessTerminatedError:
             cls._log.was_terminated = True
         else:
@@ -300,7 +409,13 @@ class UpdatableLoggableModel(UpdatableModel):
 
         cls._log.messages = ''.join(traceback.TracebackException.from_exception(exception).format())
         cls._log.time_finished = timezone.now()
-        cls._log.save()
+        cls._log.save(update_fields=[
+            log_model.time_finished.field.name,
+            log_model.was_terminated.field.name,
+            log_model.has_failed.field.name,
+            log_model.messages.field.name,
+        ])
+        cls._cached_average_update_time = None
 
 
 class HistoryModel(TimedModel):
@@ -334,3 +449,18 @@ class HistoryModel(TimedModel):
             *args,
             **kwargs
         )
+
+
+def _add_history_model_index(sender, **kwargs):
+    if not issubclass(sender, HistoryModel) or sender._meta.abstract or not sender.group_by:
+        return
+    group_by = sender.group_by
+    if not isinstance(group_by, (tuple, list)):
+        group_by = [group_by]
+    index = Index(fields=[*group_by, f'-{sender.get_date_field()}'])
+    index.set_name_with_model(sender)
+    sender._meta.indexes.append(index)
+    sender._meta.original_attrs.setdefault('indexes', sender._meta.indexes)
+
+
+class_prepared.connect(_add_history_model_index, dispatch_uid='common.models.history_model_index')
@@ -2,6 +2,7 @@ import time
 from datetime import timedelta, datetime
 from threading import Thread
 
+from django.db.migrations.state import ModelState
 from django.test import TestCase
 
 from common.models import (
@@ -290,7 +291,7 @@ class HistoryModelTestCase(DefaultTestCase):
     def assertPopulationValid(self, qs, values):
         self.assertQuerysetEqual(qs.values_list(self.model.population.field.name, flat=True), values)
 
-    def test_objects_for_date(self):
+    def create_objects(self):
         mod = self.model
         objs = [
             mod(**{
@@ -311,6 +312,10 @@ class HistoryModelTestCase(DefaultTestCase):
             ]
         ]
         mod.objects.bulk_create(objs)
+
+    def test_objects_for_date(self):
+        mod = self.model
+        self.create_objects()
         self.assertPopulationValid(mod.get_objects_for_date(datetime(2010, 1, 1)), [])
         self.assertPopulationValid(mod.get_objects_for_date(datetime(2010, 2, 1)), [10, 20, 30, 40])
         self.assertPopulationValid(mod.get_objects_for_date(datetime(2010, 2, 2)), [10, 20, 30, 40])
@@ -319,3 +324,65 @@ class HistoryModelTestCase(DefaultTestCase):
         self.assertPopulationValid(mod.get_objects_for_date(datetime(2010, 2, 5)), [12, 22, 33, 40])
         self.assertPopulationValid(mod.get_objects_for_date(datetime(2010, 2, 6)), [12, 22, 33, 40])
         self.assertPopulationValid(mod.get_objects_for_date(), [12, 22, 33, 40])
+
+    def test_composite_index_is_auto_created(self):
+        mod = self.model
+        indexes = mod._meta.indexes
+        self.assertEqual(len(indexes), 1)
+        self.assertEqual(indexes[0].fields, [*mod.get_group_by(), f'-{mod.get_date_field()}'])
+        self.assertTrue(indexes[0].name)
+
+    def test_composite_index_is_visible_to_migration_state(self):
+        mod = self.model
+        indexes = ModelState.from_model(mod).options.get('indexes', [])
+        self.assertEqual(len(indexes), 1)
+        self.assertEqual(indexes[0].fields, [*mod.get_group_by(), f'-{mod.get_date_field()}'])
+        self.assertEqual(indexes[0].name, mod._meta.indexes[0].name)
+
+    def test_objects_for_date_grouped_max_fallback(self):
+        mod = self.model
+        self.create_objects()
+        date_field = mod.get_date_field()
+        for date, values in [
+            (datetime(2010, 1, 1), []),
+            (datetime(2010, 2, 1), [10, 20, 30, 40]),
+            (datetime(2010, 2, 3), [11, 22, 30, 40]),
+            (datetime(2010, 2, 6), [12, 22, 33, 40]),
+            (None, [12, 22, 33, 40]),
+        ]:
+            filters = {f'{date_field}__lte': date} if date else {}
+            self.assertPopulationValid(
+                mod.objects.all()._for_date_grouped_max(mod.get_group_by(), date_field, filters),
+                values
+            )
+
+    def test_objects_for_date_on_prefiltered_queryset(self):
+        mod = self.model
+        self.create_objects()
+        date_field = mod.get_date_field()
+        filtered = mod.objects.filter(**{f'{mod.population.field.name}__lt': 12})
+        self.assertPopulationValid(
+            filtered.for_date(mod.get_group_by(), date_field),
+            [11]
+        )
+        self.assertPopulationValid(
+            filtered._for_date_grouped_max(mod.get_group_by(), date_field, {}),
+            [11]
+        )
+
+    def test_objects_for_date_with_tied_max_dates(self):
+        mod = self.model
+        self.create_objects()
+        date_field = mod.get_date_field()
+        tie_values = {
+            mod.country.field.name: 'A',
+            mod.city.field.name: 'x',
+            mod.date_info.field.name: datetime(2010, 2, 7),
+        }
+        mod.objects.create(**tie_values, **{mod.population.field.name: 13})
+        mod.objects.create(**tie_values, **{mod.population.field.name: 14})
+        self.assertPopulationValid(mod.get_objects_for_date(), [14, 22, 33, 40])
+        self.assertPopulationValid(
+            mod.objects.all()._for_date_grouped_max(mod.get_group_by(), date_field, {}),
+            [14, 22, 33, 40]
+        )